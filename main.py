@@ -1,17 +1,32 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import List
+from typing import Dict, List
+from contextlib import asynccontextmanager, contextmanager
 import os
-import uuid
-import json
+import secrets
+import orjson
 import logging
+import threading
 import imghdr
 
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process file locking
+    fcntl = None
+
+# Set up storage when a worker starts and write pending changes when it stops
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(bootstrap_storage)
+    yield
+    await run_in_threadpool(flush_inventory)
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -29,19 +44,19 @@ logger = logging.getLogger(__name__)
 # Configuration
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")  # Default to localhost for development
 MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 10MB limit
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Read/write uploads in 64KB chunks
 ALLOWED_IMAGE_TYPES = {"jpeg", "png", "gif"}
 
 # Directory to store uploaded images
 UPLOAD_DIR = "./uploaded_images"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # Path to the storage file
 STORAGE_FILE = "storage.json"
-
-# Ensure the storage file exists
-if not os.path.exists(STORAGE_FILE):
-    with open(STORAGE_FILE, "w") as f:
-        json.dump([], f)
+# Lock file used to serialize writes between uvicorn/gunicorn workers
+STORAGE_LOCK_FILE = f"{STORAGE_FILE}.lock"
+# Seconds to collect inventory changes before writing storage.json (0 writes on every change).
+# Only use with a single worker: other workers can't see changes that haven't been written yet.
+STORAGE_FLUSH_DELAY = float(os.getenv("STORAGE_FLUSH_DELAY", "0"))
 
 # Define InventoryItem model
 class InventoryItem(BaseModel):
@@ -51,96 +66,211 @@ class InventoryItem(BaseModel):
     category: str
     image_url: str
 
-# Load inventory from storage
+# Define ImageUpload model returned by the upload endpoint
+class ImageUpload(BaseModel):
+    image_url: str
+    full_url: str
+
+# In-memory copy of storage.json keyed by item ID, populated on first load
+_INVENTORY_CACHE = None
+# Serialized list of _INVENTORY_CACHE items served by GET /inventory, rebuilt on every save
+_INVENTORY_JSON = b"[]"
+# Identity of the storage.json the cache was read from, to pick up writes by other workers.
+# Only a cheap staleness check for reads: inode numbers get reused and mtimes can be coarse,
+# so inventory_lock() always reloads before a change.
+_INVENTORY_STAT = None
+# Handlers run in the threadpool, so cache mutations and writes are serialized
+_INVENTORY_LOCK = threading.RLock()
+# Pending delayed write of storage.json, see STORAGE_FLUSH_DELAY
+_FLUSH_TIMER = None
+
+def _storage_stat():
+    st = os.stat(STORAGE_FILE)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+# Load inventory from storage, re-reading it only if the file has changed
 def load_inventory():
+    global _INVENTORY_CACHE, _INVENTORY_JSON, _INVENTORY_STAT
     try:
-        with open(STORAGE_FILE, "r") as f:
-            return json.load(f)
+        stat = _storage_stat()
+        # Don't let a reload drop changes that are still waiting to be written
+        if stat != _INVENTORY_STAT and _FLUSH_TIMER is None:
+            with _INVENTORY_LOCK:
+                if stat != _INVENTORY_STAT and _FLUSH_TIMER is None:
+                    with open(STORAGE_FILE, "rb") as f:
+                        data = orjson.loads(f.read())
+                    # Validate once here so handlers can trust cached items;
+                    # dumping drops any keys that aren't part of the schema
+                    data = [InventoryItem.model_validate(item).model_dump() for item in data]
+                    _INVENTORY_JSON = orjson.dumps(data)
+                    _INVENTORY_CACHE = {item["id"]: item for item in data}
+                    _INVENTORY_STAT = stat
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading inventory: {str(e)}")
+    return _INVENTORY_CACHE
+
+# Save inventory to storage, either now or after STORAGE_FLUSH_DELAY
+def save_inventory():
+    global _INVENTORY_JSON, _INVENTORY_STAT
+    with _INVENTORY_LOCK:
+        data = list(_INVENTORY_CACHE.values())
+        _INVENTORY_JSON = orjson.dumps(data)
+        if STORAGE_FLUSH_DELAY <= 0:
+            try:
+                _write_storage(data)
+            except Exception as e:
+                # The cache already holds the change; force the next load to
+                # re-read storage.json so it doesn't serve data that wasn't saved
+                _INVENTORY_STAT = None
+                raise HTTPException(status_code=500, detail=f"Error saving inventory: {str(e)}")
+        elif _FLUSH_TIMER is None:
+            # Changes made before the timer fires are written together
+            _schedule_flush()
+
+def _schedule_flush():
+    global _FLUSH_TIMER
+    _FLUSH_TIMER = threading.Timer(STORAGE_FLUSH_DELAY, flush_inventory)
+    _FLUSH_TIMER.daemon = True
+    _FLUSH_TIMER.start()
+
+# Write any pending inventory changes to storage
+def flush_inventory():
+    global _FLUSH_TIMER
+    with _INVENTORY_LOCK:
+        if _FLUSH_TIMER is None:
+            return
+        _FLUSH_TIMER.cancel()
+        try:
+            _write_storage(list(_INVENTORY_CACHE.values()))
+            _FLUSH_TIMER = None
+        except Exception:
+            logger.exception("Error saving inventory, retrying")
+            _schedule_flush()
+
+def _write_storage(data):
+    global _INVENTORY_STAT
+    # Write to a temp file and swap it in so other workers never read a partial file
+    tmp_file = f"{STORAGE_FILE}.tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_file, STORAGE_FILE)
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    _INVENTORY_STAT = _storage_stat()
+
+# Hold while reading, changing and saving the inventory.
+# Serializes threads in this worker and, where flock is available, other workers.
+@contextmanager
+def inventory_lock():
+    global _INVENTORY_STAT
+    with _INVENTORY_LOCK:
+        if fcntl is None:
+            yield
+            return
+        with open(STORAGE_LOCK_FILE, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another worker may have written storage.json without changing its
+            # stat key, so make the next load_inventory() re-read it
+            _INVENTORY_STAT = None
+            yield
+
+# Look up an inventory item by ID, raising 404 if it doesn't exist
+def get_item_or_404(item_id):
+    item = load_inventory().get(item_id)
+    if not item:
+        raise HTTPException(status_code=404, detail="Inventory item not found.")
+    return item
+
+# Ensure image_url starts with /images/
+def validate_image_url(image_url):
+    if not image_url.startswith("/images/"):
+        raise HTTPException(status_code=400, detail="Invalid image URL format. Must start with /images/")
 
-# Save inventory to storage
-def save_inventory(data):
-    with open(STORAGE_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+# Create the upload dir and storage file if missing, then preload the cache.
+# Runs once per worker; the lock keeps workers starting together from racing.
+def bootstrap_storage():
+    with inventory_lock():
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        # Ensure the storage file exists
+        if not os.path.exists(STORAGE_FILE):
+            with open(STORAGE_FILE, "wb") as f:
+                f.write(orjson.dumps([]))
+        load_inventory()
 
-@app.post("/images/upload")
+def _save_upload(src, path):
+    """
+    Copy an upload to path in fixed-size chunks.
+    Returns False (and removes the partial file) if it exceeds MAX_IMAGE_SIZE.
+    """
+    size = 0
+    with open(path, "wb") as f:
+        while chunk := src.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_IMAGE_SIZE:
+                break
+            f.write(chunk)
+    if size > MAX_IMAGE_SIZE:
+        os.remove(path)
+        return False
+    return True
+
+@app.post("/images/upload", response_model=ImageUpload)
 async def upload_image(file: UploadFile = File(...)):
     """
     Upload an image and store it in the UPLOAD_DIR.
     Returns both the relative path and full URL of the uploaded image.
     """
-    # Check file size
-    content = await file.read()
-    if len(content) > MAX_IMAGE_SIZE:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File size exceeds maximum limit of {MAX_IMAGE_SIZE/1024/1024}MB"
-        )
-    
-    # Verify it's an image
-    image_type = imghdr.what(None, content)
+    # Verify it's an image (the header is enough to detect the format)
+    header = await file.read(32)
+    image_type = imghdr.what(None, header)
     if not image_type or image_type not in ALLOWED_IMAGE_TYPES:
         raise HTTPException(
             status_code=400,
             detail=f"Invalid image format. Allowed formats: {', '.join(ALLOWED_IMAGE_TYPES)}"
         )
+    await file.seek(0)
 
-    # Generate a unique filename
-    file_id = str(uuid.uuid4())
-    file_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    # Generate a unique filename; the extension comes from the detected format,
+    # never from the client-supplied filename
+    filename = f"{secrets.token_hex(16)}.{image_type}"
+    file_path = os.path.join(UPLOAD_DIR, filename)
 
-    # Save the file locally
-    with open(file_path, "wb") as f:
-        f.write(content)
+    # Stream the file to disk without blocking the event loop, checking its size
+    if not await run_in_threadpool(_save_upload, file.file, file_path):
+        raise HTTPException(
+            status_code=400,
+            detail=f"File size exceeds maximum limit of {MAX_IMAGE_SIZE/1024/1024}MB"
+        )
 
     # Create both relative path and full URL
-    relative_path = f"/images/{file_id}_{file.filename}"
+    relative_path = f"/images/{filename}"
     file_url = f"{BASE_URL}{relative_path}"
     
-    return JSONResponse(content={
-        "image_url": relative_path,  # Store relative path
-        "full_url": file_url        # Also provide full URL for convenience
-    })
-
-@app.get("/images/{filename}")
-async def get_image(filename: str):
-    """
-    Serve uploaded images with proper content type.
-    """
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Image not found.")
-    
-    # Determine content type based on file extension
-    content_type = "image/jpeg"  # default
-    if filename.lower().endswith(".png"):
-        content_type = "image/png"
-    elif filename.lower().endswith(".gif"):
-        content_type = "image/gif"
-    
-    return FileResponse(file_path, media_type=content_type)
+    return ImageUpload.model_construct(
+        image_url=relative_path,  # Store relative path
+        full_url=file_url         # Also provide full URL for convenience
+    )
 
-@app.get("/inventory", response_model=List[InventoryItem])
-async def get_inventory():
+@app.get("/inventory", responses={200: {"model": List[InventoryItem]}})
+def get_inventory():
     """
     Retrieve all inventory items.
     """
-    return load_inventory()
+    load_inventory()
+    return Response(content=_INVENTORY_JSON, media_type="application/json")
 
 @app.get("/inventory/{item_id}", response_model=InventoryItem)
-async def get_inventory_item(item_id: str):
+def get_inventory_item(item_id: str):
     """
     Retrieve a specific inventory item by ID.
     """
-    inventory = load_inventory()
-    item = next((item for item in inventory if item["id"] == item_id), None)
-    if not item:
-        raise HTTPException(status_code=404, detail="Inventory item not found.")
-    return item
+    return InventoryItem.model_construct(**get_item_or_404(item_id))
 
 @app.post("/inventory", response_model=InventoryItem)
-async def create_inventory_item(
+def create_inventory_item(
     name: str = Form(...),
     description: str = Form(...),
     category: str = Form(...),
@@ -150,12 +280,8 @@ async def create_inventory_item(
     Create a new inventory item.
     Expects image_url to be a relative path returned from the upload endpoint.
     """
-    inventory = load_inventory()
-    item_id = str(uuid.uuid4())
-    
-    # Ensure image_url starts with /images/
-    if not image_url.startswith("/images/"):
-        raise HTTPException(status_code=400, detail="Invalid image URL format. Must start with /images/")
+    item_id = secrets.token_hex(16)
+    validate_image_url(image_url)
 
     item = {
         "id": item_id,
@@ -164,12 +290,14 @@ async def create_inventory_item(
         "category": category,
         "image_url": image_url,
     }
-    inventory.append(item)
-    save_inventory(inventory)
-    return item
+    with inventory_lock():
+        load_inventory()[item_id] = item
+        save_inventory()
+    # Built from validated form fields, so skip re-validating in response_model
+    return InventoryItem.model_construct(**item)
 
 @app.put("/inventory/{item_id}", response_model=InventoryItem)
-async def update_inventory_item(
+def update_inventory_item(
     item_id: str,
     name: str = Form(...),
     description: str = Form(...),
@@ -179,74 +307,74 @@ async def update_inventory_item(
     """
     Update an existing inventory item.
     """
-    inventory = load_inventory()
-    item = next((item for item in inventory if item["id"] == item_id), None)
-    if not item:
-        raise HTTPException(status_code=404, detail="Inventory item not found.")
-    
-    # Ensure image_url starts with /images/
-    if not image_url.startswith("/images/"):
-        raise HTTPException(status_code=400, detail="Invalid image URL format. Must start with /images/")
-    
-    item.update({
-        "name": name,
-        "description": description,
-        "category": category,
-        "image_url": image_url,
-    })
-    save_inventory(inventory)
-    return item
+    with inventory_lock():
+        item = get_item_or_404(item_id)
+        validate_image_url(image_url)
+
+        item.update({
+            "name": name,
+            "description": description,
+            "category": category,
+            "image_url": image_url,
+        })
+        save_inventory()
+    return InventoryItem.model_construct(**item)
 
-@app.delete("/inventory/{item_id}")
-async def delete_inventory_item(item_id: str):
+@app.delete("/inventory/{item_id}", response_model=Dict[str, str])
+def delete_inventory_item(item_id: str):
     """
     Delete an inventory item by ID.
     """
-    inventory = load_inventory()
-    item = next((item for item in inventory if item["id"] == item_id), None)
-    if not item:
-        raise HTTPException(status_code=404, detail="Inventory item not found.")
-    
-    inventory.remove(item)
-    save_inventory(inventory)
+    with inventory_lock():
+        inventory = load_inventory()
+        if inventory.pop(item_id, None) is None:
+            raise HTTPException(status_code=404, detail="Inventory item not found.")
+        save_inventory()
     return {"detail": f"Item with ID {item_id} has been deleted."}
 
+# Serialized OpenAPI schema, built once by update_openapi_servers()
+_OPENAPI_BYTES = b""
+
 # Add servers dynamically
 def update_openapi_servers():
+    global _OPENAPI_BYTES
     app.openapi_schema = None  # Clear cached schema
     schema = app.openapi()
     schema["servers"] = [{"url": BASE_URL}]
     app.openapi_schema = schema
+    _OPENAPI_BYTES = orjson.dumps(schema)
 
 @app.get("/openapi.yaml")
 async def get_openapi_spec():
-    update_openapi_servers()
-    return JSONResponse(content=app.openapi())
+    return Response(content=_OPENAPI_BYTES, media_type="application/json")
+
+# Plugin manifest only depends on BASE_URL, so serialize it once at import
+_MANIFEST_BYTES = orjson.dumps({
+    "schema_version": "v1",
+    "name_for_human": "Inventory Manager",
+    "name_for_model": "inventory_manager",
+    "description_for_human": "Manage your inventory with images and descriptions.",
+    "description_for_model": "Plugin for managing inventory items with CRUD operations and image upload capabilities.",
+    "auth": {
+        "type": "none"
+    },
+    "api": {
+        "type": "openapi",
+        "url": f"{BASE_URL}/openapi.yaml",
+        "has_user_authentication": False
+    },
+    "logo_url": f"{BASE_URL}/static/logo.png",
+    "contact_email": "support@example.com",
+    "legal_info_url": "https://example.com/legal"
+})
 
 @app.get("/plugin_manifest.json")
 async def get_plugin_manifest():
-    manifest = {
-        "schema_version": "v1",
-        "name_for_human": "Inventory Manager",
-        "name_for_model": "inventory_manager",
-        "description_for_human": "Manage your inventory with images and descriptions.",
-        "description_for_model": "Plugin for managing inventory items with CRUD operations and image upload capabilities.",
-        "auth": {
-            "type": "none"
-        },
-        "api": {
-            "type": "openapi",
-            "url": f"{BASE_URL}/openapi.yaml",
-            "has_user_authentication": False
-        },
-        "logo_url": f"{BASE_URL}/static/logo.png",
-        "contact_email": "support@example.com",
-        "legal_info_url": "https://example.com/legal"
-    }
-    return JSONResponse(content=manifest)
+    return Response(content=_MANIFEST_BYTES, media_type="application/json")
 
-# Mount the uploaded images directory
-app.mount("/images", StaticFiles(directory=UPLOAD_DIR), name="images")
+# Mount the uploaded images directory (serves GET /images/{filename}).
+# The directory is created on startup, so don't check for it at import.
+app.mount("/images", StaticFiles(directory=UPLOAD_DIR, check_dir=False), name="images")
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 update_openapi_servers()  # Update servers on startup